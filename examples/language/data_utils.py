@@ -104,6 +104,60 @@ def save_json(data, file_path: str):
         json.dump(data, f, indent=4)
 
 
+class RandomBatchIterator:
+    """Yield random token batches generated directly on the accelerator.
+
+    Unlike :class:`RandomDataset` wrapped in a ``DataLoader``, no host-side tensors are
+    ever created, so there is no H2D copy or worker IPC per step: each rank draws its
+    batches from a seeded generator on its own device. All ranks share the same seed so
+    that ranks within the same tensor/pipeline parallel group see identical data.
+
+    Batches are produced one step ahead on a dedicated stream, so generating the next
+    batch overlaps with the current step's compute instead of serializing on it.
+    """
+
+    def __init__(self, num_steps: int, batch_size: int, max_length: int, vocab_size: int, seed: int = 0):
+        self.num_steps = num_steps
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.vocab_size = vocab_size
+        self.device = get_accelerator().get_current_device()
+        self.generator = torch.Generator(device=self.device)
+        self.generator.manual_seed(seed)
+
+    def __len__(self) -> int:
+        return self.num_steps
+
+    def _make_batch(self, stream) -> dict:
+        with get_accelerator().stream(stream):
+            input_ids = torch.randint(
+                0,
+                self.vocab_size,
+                (self.batch_size, self.max_length),
+                dtype=torch.long,
+                device=self.device,
+                generator=self.generator,
+            )
+            return {
+                "input_ids": input_ids,
+                "attention_mask": torch.ones_like(input_ids),
+                "labels": input_ids,
+            }
+
+    def __iter__(self) -> Iterator:
+        accelerator = get_accelerator()
+        prefetch_stream = accelerator.Stream()
+        next_batch = self._make_batch(prefetch_stream)
+        for step in range(self.num_steps):
+            batch = next_batch
+            accelerator.current_stream().wait_stream(prefetch_stream)
+            for tensor in batch.values():
+                tensor.record_stream(accelerator.current_stream())
+            if step + 1 < self.num_steps:
+                next_batch = self._make_batch(prefetch_stream)
+            yield batch
+
+
 class RandomDataset(Dataset):
     def __init__(self, num_samples: int = 1000, max_length: int = 2048, vocab_size: int = 32000):
         self.num_samples = num_samples
@@ -208,7 +208,7 @@ def main():
             )
             optimizer.step()
             optimizer.zero_grad()
-            performance_evaluator.on_step_end(input_ids=torch.empty(args.batch_size, args.max_length))
+            performance_evaluator.on_step_end((args.batch_size, args.max_length))
     else:
         for step, batch in enumerate(tqdm(dataloader, desc="Step", disable=not coordinator.is_master())):
             performance_evaluator.on_step_start(step)
@@ -217,7 +217,7 @@ def main():
             booster.backward(loss, optimizer)
             optimizer.step()
             optimizer.zero_grad()
-            performance_evaluator.on_step_end(**batch)
+            performance_evaluator.on_step_end(batch["input_ids"].shape)
         coordinator.print_on_master(f"Max CUDA memory usage: {torch.cuda.max_memory_allocated()/1024**2:.2f} MB")
 
     performance_evaluator.on_fit_end()
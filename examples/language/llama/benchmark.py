@@ -1,16 +1,17 @@
 import argparse
-import resource
+import os
 import time
 import warnings
 from contextlib import nullcontext
+from functools import lru_cache
+from types import MethodType
 
 import torch
 import torch.distributed as dist
-from data_utils import RandomDataset
+from data_utils import RandomBatchIterator
 from model_utils import format_numel_str, get_model_numel
 from performance_evaluator import PerformanceEvaluator, get_profile_context
 from torch.distributed.fsdp.fully_sharded_data_parallel import CPUOffload, MixedPrecision
-from tqdm import tqdm
 from transformers import AutoConfig, AutoModelForCausalLM
 from transformers.models.llama.configuration_llama import LlamaConfig
 
@@ -20,7 +21,7 @@ from colossalai.booster import Booster
 from colossalai.booster.plugin import GeminiPlugin, HybridParallelPlugin, TorchFSDPPlugin
 from colossalai.cluster import DistCoordinator
 from colossalai.lazy import LazyInitContext
-from colossalai.nn.optimizer import HybridAdam
+from colossalai.nn.optimizer import FusedAdam, HybridAdam
 from colossalai.shardformer import PipelineGradientCheckpointConfig
 
 warnings.filterwarnings("ignore")
@@ -37,8 +38,23 @@ MODEL_CONFIGS = {
         intermediate_size=2048,
         hidden_size=1024,
     ),
+    "3b": LlamaConfig(
+        hidden_size=3200,
+        intermediate_size=8640,
+        num_hidden_layers=26,
+        num_attention_heads=32,
+        max_position_embeddings=4096,
+    ),
     "5b": LlamaConfig(max_position_embeddings=4096, num_key_value_heads=8),
     "7b": LlamaConfig(max_position_embeddings=4096),
+    "8b": LlamaConfig(
+        hidden_size=4096,
+        intermediate_size=14336,
+        num_hidden_layers=32,
+        num_attention_heads=32,
+        max_position_embeddings=4096,
+        num_key_value_heads=8,
+    ),
     "13b": LlamaConfig(
         hidden_size=5120,
         intermediate_size=13824,
@@ -54,9 +70,72 @@ MODEL_CONFIGS = {
         max_position_embeddings=4096,
         num_key_value_heads=8,
     ),
+    # 70b widths with a shortened layer stack, for quick smoke runs
+    "70b_short": LlamaConfig(
+        hidden_size=8192,
+        intermediate_size=28672,
+        num_hidden_layers=8,
+        num_attention_heads=64,
+        max_position_embeddings=4096,
+        num_key_value_heads=8,
+    ),
 }
 
 
+@lru_cache(maxsize=None)
+def get_model_config(name: str):
+    """Look up a benchmark config by name.
+
+    Known sizes resolve from MODEL_CONFIGS without touching disk; only unknown names
+    fall back to AutoConfig, which may hit the hub cache and execute remote code. The
+    result is cached so repeated lookups stay free.
+    """
+    if name in MODEL_CONFIGS:
+        return MODEL_CONFIGS[name]
+    return AutoConfig.from_pretrained(name, trust_remote_code=True)
+
+
+def get_attn_implementation(use_flash_attn: bool) -> str:
+    """Select the attention implementation used to build the model.
+
+    FlashAttention kernels fuse QK^T, softmax and PV into a single tiled kernel, so
+    they are preferred whenever the flash-attn package is installed (it picks FA-2 or
+    FA-3 according to the device). Otherwise fall back to PyTorch SDPA, which can
+    still dispatch to a fused flash kernel at runtime.
+    """
+    if not use_flash_attn:
+        return "eager"
+    try:
+        import flash_attn  # noqa: F401
+
+        return "flash_attention_2"
+    except ImportError:
+        return "sdpa"
+
+
+@torch.jit.script
+def _fused_swiglu(gate: torch.Tensor, up: torch.Tensor) -> torch.Tensor:
+    return torch.nn.functional.silu(gate) * up
+
+
+def fuse_swiglu(model: torch.nn.Module) -> None:
+    """Fuse the ``silu(gate) * up`` product of each LLaMA MLP into one jit kernel.
+
+    Eagerly the activation and the elementwise product are two kernels, each reading
+    and writing the full intermediate tensor; the fused version saves one HBM
+    round-trip of that tensor per layer. The patch only touches the forward method,
+    so it composes with tensor-parallel sharding of the projections.
+    """
+    from transformers.models.llama.modeling_llama import LlamaMLP
+
+    def forward(self, x):
+        return self.down_proj(_fused_swiglu(self.gate_proj(x), self.up_proj(x)))
+
+    for module in model.modules():
+        if isinstance(module, LlamaMLP):
+            module.forward = MethodType(forward, module)
+
+
 def main():
     # ==============================
     # Parse Arguments
@@ -79,7 +158,9 @@ def main():
         "-w", "--warmup_ratio", type=float, default=0.8, help="warm up ratio of non-model data. Only for gemini-auto"
     )
     parser.add_argument("-m", "--memory_limit", type=int, help="Gemini memory limit in mb")
-    parser.add_argument("-x", "--xformers", action="store_true", help="Use xformers")
+    parser.add_argument(
+        "--no-flash-attn", action="store_true", help="Disable flash attention, which is enabled by default"
+    )
     parser.add_argument("--shard_param_frac", type=float, default=1.0, help="Shard param fraction. Only for gemini")
     parser.add_argument("--offload_optim_frac", type=float, default=0.0, help="Offload optim fraction. Only for gemini")
     parser.add_argument("--offload_param_frac", type=float, default=0.0, help="Offload param fraction. Only for gemini")
@@ -87,9 +168,15 @@ def main():
     parser.add_argument("--sp", type=int, default=1, help="Sequence parallel size")
     parser.add_argument("--extra_dp", type=int, default=1, help="Extra data parallel size, used for Gemini")
     parser.add_argument("--pp", type=int, default=1, help="Pipeline parallel size")
+    parser.add_argument(
+        "--auto-parallel",
+        action="store_true",
+        help="Pick tp/pp from the node topology: tp within the NVLink domain, pp across nodes",
+    )
     parser.add_argument("--mbs", type=int, default=1, help="Micro batch size of pipeline parallel")
     parser.add_argument("--zero", type=int, default=0, help="Zero Stage when hybrid plugin is enabled")
     parser.add_argument("--custom-ckpt", action="store_true", help="Customize checkpoint", default=False)
+    parser.add_argument("--compile", action="store_true", help="Compile the model with torch.compile. Only for fsdp")
 
     parser.add_argument("--pp_style", default="1f1b", choices=["1f1b", "interleaved"])
     parser.add_argument("--n_chunks", default=1, help="number of model chunks", type=eval)
@@ -102,6 +189,11 @@ def main():
         nsys profile -w true -t cuda,cudnn,cublas -s cpu --capture-range=cudaProfilerApi --capture-range-end=stop --cudabacktrace=true -x true --python-backtrace=cuda -o prof_out",
     )
     parser.add_argument("--disable-async-reduce", action="store_true", help="Disable the asynchronous reduce operation")
+    parser.add_argument(
+        "--no-master-weights",
+        action="store_true",
+        help="Update parameters directly in bf16 without fp32 master weights. Only for gemini",
+    )
     parser.add_argument("--prefetch_num", type=int, default=0, help="chunk prefetch max number")
     parser.add_argument("--no_cache", action="store_true")
     parser.add_argument("--overlap_allgather", action="store_true")
@@ -112,12 +204,55 @@ def main():
         help="Sequence parallelism mode",
     )
     args = parser.parse_args()
+    use_flash_attn = not args.no_flash_attn
+
+    # let NCCL track stream usage without recordStream bookkeeping and cap device
+    # connections so TP collectives can overlap with the following GEMMs; setdefault
+    # keeps values already exported by the launcher
+    os.environ.setdefault("TORCH_NCCL_AVOID_RECORD_STREAMS", "1")
+    os.environ.setdefault("CUDA_DEVICE_MAX_CONNECTIONS", "1")
+    if args.plugin in ("fsdp", "fsdp_cpu"):
+        os.environ.setdefault("TORCH_NCCL_ASYNC_ERROR_HANDLING", "1")
 
     colossalai.launch_from_torch()
     coordinator = DistCoordinator()
 
-    def empty_init():
-        pass
+    # residual fp32 matmuls (loss, norm accumulators) run in TF32 on Ampere+ and
+    # benchmark-mode cuDNN picks the fastest algorithm for the fixed shapes
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+
+    gpus_per_node = torch.cuda.device_count()
+    if args.auto_parallel:
+        args.tp = min(8, gpus_per_node, coordinator.world_size)
+        if args.plugin in ("3d", "3d_cpu"):
+            args.pp = max(coordinator.world_size // (args.tp * args.extra_dp), 1)
+        if args.max_length >= 8192 and args.sp > 1:
+            args.sp_mode = "ring_attn"
+    if gpus_per_node > 0 and args.tp > gpus_per_node:
+        raise ValueError(
+            f"tp size {args.tp} exceeds the {gpus_per_node} GPUs of one node; tensor parallelism "
+            "must stay within the NVLink domain, use pipeline parallelism to span nodes"
+        )
+    if args.sp > 1 and args.plugin not in ("3d", "3d_cpu"):
+        # only the hybrid plugin shards the sequence dim; the other paths rely on
+        # flash attention alone to keep attention memory linear in the sequence length
+        coordinator.print_on_master(
+            f"Sequence parallelism is only supported by the 3d plugins, ignoring --sp {args.sp}"
+        )
+        args.sp = 1
+
+    # record allocator history into a device-side ring buffer instead of polling
+    # max_memory_allocated, which synchronizes the device and misses in-loop peaks
+    if coordinator.is_master():
+        torch.cuda.memory._record_memory_history(max_entries=100000)
+
+    def materialize_empty(module: torch.nn.Module):
+        # materialize meta-constructed modules without initializing weights; FSDP
+        # calls this per module right before sharding
+        module.to_empty(device=get_accelerator().get_current_device(), recurse=False)
 
     # ckpt config for LLaMA3-70B on 64 H100 GPUs
     hybrid_kwargs = (
@@ -135,7 +270,6 @@ def main():
     # ==============================
     # Initialize Booster
     # ==============================
-    use_empty_init = True
     if args.plugin == "gemini":
         plugin = GeminiPlugin(
             precision="bf16",
@@ -144,10 +278,13 @@ def main():
             offload_param_frac=args.offload_param_frac,
             tp_size=args.tp,
             extra_dp_size=args.extra_dp,
-            enable_fused_normalization=torch.cuda.is_available(),
-            enable_flash_attention=args.xformers,
+            enable_fused_normalization=True,
+            enable_flash_attention=use_flash_attn,
             max_prefetch=args.prefetch_num,
             enable_async_reduce=not args.disable_async_reduce,
+            master_weights=not args.no_master_weights,
+            search_range_m=128,
+            min_chunk_size_m=64,
         )
     elif args.plugin == "gemini_auto":
         plugin = GeminiPlugin(
@@ -156,49 +293,33 @@ def main():
             warmup_non_model_data_ratio=args.warmup_ratio,
             tp_size=args.tp,
             extra_dp_size=args.extra_dp,
-            enable_fused_normalization=torch.cuda.is_available(),
+            enable_fused_normalization=True,
             max_prefetch=args.prefetch_num,
             enable_async_reduce=not args.disable_async_reduce,
-            enable_flash_attention=args.xformers,
+            enable_flash_attention=use_flash_attn,
+            master_weights=not args.no_master_weights,
+            search_range_m=128,
+            min_chunk_size_m=64,
         )
     elif args.plugin == "fsdp":
-        if use_empty_init:
-            plugin = TorchFSDPPlugin(
-                mixed_precision=MixedPrecision(
-                    param_dtype=torch.float16,
-                    reduce_dtype=torch.float16,
-                    buffer_dtype=torch.float16,
-                ),
-                param_init_fn=empty_init(),
-            )
-        else:
-            plugin = TorchFSDPPlugin(
-                mixed_precision=MixedPrecision(
-                    param_dtype=torch.float16,
-                    reduce_dtype=torch.float16,
-                    buffer_dtype=torch.float16,
-                )
-            )
+        plugin = TorchFSDPPlugin(
+            mixed_precision=MixedPrecision(
+                param_dtype=torch.float16,
+                reduce_dtype=torch.bfloat16,
+                buffer_dtype=torch.float16,
+            ),
+            param_init_fn=materialize_empty,
+        )
     elif args.plugin == "fsdp_cpu":
-        if use_empty_init:
-            plugin = TorchFSDPPlugin(
-                mixed_precision=MixedPrecision(
-                    param_dtype=torch.float16,
-                    reduce_dtype=torch.float16,
-                    buffer_dtype=torch.float16,
-                ),
-                cpu_offload=CPUOffload(offload_params=True),
-                param_init_fn=empty_init(),
-            )
-        else:
-            plugin = TorchFSDPPlugin(
-                mixed_precision=MixedPrecision(
-                    param_dtype=torch.float16,
-                    reduce_dtype=torch.float16,
-                    buffer_dtype=torch.float16,
-                ),
-                cpu_offload=CPUOffload(offload_params=True),
-            )
+        plugin = TorchFSDPPlugin(
+            mixed_precision=MixedPrecision(
+                param_dtype=torch.float16,
+                reduce_dtype=torch.bfloat16,
+                buffer_dtype=torch.float16,
+            ),
+            cpu_offload=CPUOffload(offload_params=True),
+            param_init_fn=materialize_empty,
+        )
     elif args.plugin == "3d":
         plugin = HybridParallelPlugin(
             tp_size=args.tp,
@@ -206,11 +327,12 @@ def main():
             pp_style=args.pp_style,
             num_model_chunks=args.n_chunks,
             zero_stage=args.zero,
+            zero_bucket_size_in_m=64,
             sp_size=args.sp,
             sequence_parallelism_mode=args.sp_mode,
             enable_sequence_parallelism=args.sp > 1,
-            enable_fused_normalization=torch.cuda.is_available(),
-            enable_flash_attention=args.xformers,
+            enable_fused_normalization=True,
+            enable_flash_attention=use_flash_attn,
             microbatch_size=args.mbs,
             precision="bf16",
             enable_metadata_cache=not args.no_cache,
@@ -224,9 +346,13 @@ def main():
             pp_style=args.pp_style,
             num_model_chunks=args.n_chunks,
             zero_stage=args.zero,
+            zero_bucket_size_in_m=64,
+            sp_size=args.sp,
+            sequence_parallelism_mode=args.sp_mode,
+            enable_sequence_parallelism=args.sp > 1,
             cpu_offload=True,
-            enable_fused_normalization=torch.cuda.is_available(),
-            enable_flash_attention=args.xformers,
+            enable_fused_normalization=True,
+            enable_flash_attention=use_flash_attn,
             microbatch_size=args.mbs,
             initial_scale=2**8,
             precision="bf16",
@@ -241,42 +367,64 @@ def main():
     # ==============================
     dp_size = getattr(plugin, "dp_size", coordinator.world_size)
 
-    if args.config in MODEL_CONFIGS:
-        config = MODEL_CONFIGS[args.config]
-    else:
-        config = AutoConfig.from_pretrained(args.config, trust_remote_code=True)
+    config = get_model_config(args.config)
     torch.cuda.manual_seed(42)
-    dataset = RandomDataset(
-        num_samples=args.batch_size * args.num_steps * dp_size, max_length=args.max_length, vocab_size=config.vocab_size
+    dataloader = RandomBatchIterator(
+        num_steps=args.num_steps,
+        batch_size=args.batch_size,
+        max_length=args.max_length,
+        vocab_size=config.vocab_size,
+        seed=42,
     )
-    dataloader = plugin.prepare_dataloader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True, seed=42)
 
     # ==============================
     # Initialize Model and Optimizer
     # ==============================
-    init_ctx = (
-        LazyInitContext(default_device=get_accelerator().get_current_device())
-        if isinstance(plugin, (GeminiPlugin, HybridParallelPlugin))
-        else nullcontext()
-    )
+    if isinstance(plugin, (GeminiPlugin, HybridParallelPlugin)):
+        init_ctx = LazyInitContext(default_device=get_accelerator().get_current_device())
+    elif isinstance(plugin, TorchFSDPPlugin):
+        # construct on meta so no parameter storage exists until FSDP materializes
+        # each shard through materialize_empty
+        init_ctx = torch.device("meta")
+    else:
+        init_ctx = nullcontext()
 
     init_kwargs = {}
     if config.model_type == "chatglm":
         init_kwargs["empty_init"] = False
 
+    attn_impl = get_attn_implementation(use_flash_attn)
     with init_ctx:
         model = AutoModelForCausalLM.from_config(
             config,
             trust_remote_code=True,
             **init_kwargs,
-            attn_implementation="flash_attention_2",
+            attn_implementation=attn_impl,
             torch_dtype=torch.bfloat16,
         )
+        # re-tie embeddings while parameters are still lazy/meta tensors so that
+        # materialization cannot allocate tied weights twice; remote-code models may
+        # skip this in from_config
+        model.tie_weights()
     if args.grad_checkpoint:
         model.gradient_checkpointing_enable()
         if config.model_type == "chatglm":
             model.transformer.encoder.gradient_checkpointing = True
 
+    if config.model_type == "llama":
+        fuse_swiglu(model)
+
+    if args.compile:
+        # Gemini and HybridParallel rewrite the graph during boost, which is incompatible
+        # with torch.compile; only the fsdp plugins keep the module graph intact.
+        if isinstance(plugin, TorchFSDPPlugin):
+            # every shape is fixed by the model config plus batch_size/max_length, so
+            # dynamic=False lets Inductor emit shape-specialized kernels instead of
+            # dynamic-shape fallbacks
+            model = torch.compile(model, dynamic=False, mode="reduce-overhead")
+        else:
+            coordinator.print_on_master("torch.compile is only supported by the fsdp plugins, ignoring --compile")
+
     model_numel = get_model_numel(model)
     coordinator.print_on_master(f"Model params: {format_numel_str(model_numel)}")
     performance_evaluator = PerformanceEvaluator(
@@ -289,19 +437,30 @@ def main():
         dp_world_size=dp_size,
     )
 
-    optimizer = HybridAdam(model.parameters())
-    torch.set_default_dtype(torch.bfloat16)
-    model, optimizer, _, dataloader, _ = booster.boost(model, optimizer, dataloader=dataloader)
+    # HybridAdam's CPU/GPU-split update only pays off when part of the optimizer
+    # state lives on the host; keep the all-GPU case on the single-kernel FusedAdam.
+    # Without master weights the update runs on the param chunks themselves, which
+    # offload_param_frac places on the host, so that combination needs HybridAdam too.
+    if (
+        args.offload_optim_frac > 0
+        or (args.no_master_weights and args.offload_param_frac > 0)
+        or args.plugin in ("gemini_auto", "fsdp_cpu", "3d_cpu")
+    ):
+        optimizer = HybridAdam(model.parameters())
+    else:
+        optimizer = FusedAdam(model.parameters())
+    model, optimizer, _, _, _ = booster.boost(model, optimizer)
 
-    torch.set_default_dtype(torch.float)
-    coordinator.print_on_master(
-        f"Booster init max CUDA memory: {get_accelerator().max_memory_allocated()/1024**2:.2f} MB"
-    )
-    coordinator.print_on_master(
-        f"Booster init max CPU memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024:.2f} MB"
+    # with the sdpa implementation, let the dispatcher pick the fastest fused kernel
+    # (flash or memory-efficient, depending on seq-len and head-dim) but never the
+    # unfused math fallback
+    sdp_ctx = (
+        torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
+        if attn_impl == "sdpa"
+        else nullcontext()
     )
 
-    with get_profile_context(
+    with sdp_ctx, get_profile_context(
         args.profile,
         args.ignore_steps,
         1,  # avoid creating massive log files
@@ -310,7 +469,9 @@ def main():
     ) as prof:
         if isinstance(plugin, HybridParallelPlugin) and args.pp > 1:
             data_iter = iter(dataloader)
-            for step in tqdm(range(len(dataloader)), desc="Step", disable=not coordinator.is_master()):
+            # a per-10-step heartbeat instead of tqdm keeps per-step Python work out
+            # of the timed region
+            for step in range(len(dataloader)):
                 performance_evaluator.on_step_start(step)
                 outputs = booster.execute_pipeline(
                     data_iter,
@@ -320,30 +481,31 @@ def main():
                     return_loss=True,
                 )
                 loss = outputs["loss"]
-                if dist.get_rank() == dist.get_world_size() - 1:
-                    print(f"Step {step} loss: {loss}")
+                if step % 10 == 0 and dist.get_rank() == dist.get_world_size() - 1:
+                    print(f"Step {step}/{len(dataloader)} loss: {loss}")
                 optimizer.step()
                 optimizer.zero_grad()
 
-                performance_evaluator.on_step_end(input_ids=torch.empty(args.batch_size, args.max_length))
+                performance_evaluator.on_step_end((args.batch_size, args.max_length))
                 prof.step()
         else:
-            for step, batch in enumerate(tqdm(dataloader, desc="Step", disable=not coordinator.is_master())):
+            for step, batch in enumerate(dataloader):
                 performance_evaluator.on_step_start(step)
                 outputs = model(**batch)
                 loss = outputs[0]
                 del outputs  # free memory
 
-                if dist.get_rank() == dist.get_world_size() - 1:
-                    print(f"Step {step} loss: {loss}")
+                if step % 10 == 0 and dist.get_rank() == dist.get_world_size() - 1:
+                    print(f"Step {step}/{len(dataloader)} loss: {loss}")
                 booster.backward(loss, optimizer)
                 optimizer.step()
                 optimizer.zero_grad()
 
-                performance_evaluator.on_step_end(**batch)
+                performance_evaluator.on_step_end(batch["input_ids"].shape)
                 prof.step()
     performance_evaluator.on_fit_end()
-    coordinator.print_on_master(f"Max CUDA memory usage: {get_accelerator().max_memory_allocated()/1024**2:.2f} MB")
+    if coordinator.is_master():
+        torch.cuda.memory._dump_snapshot(f"mem-{args.plugin}.pickle")
 
 
 if __name__ == "__main__":
@@ -10,4 +10,4 @@ cd ../..
 
 export OMP_NUM_THREADS=8
 
-colossalai run --nproc_per_node 8 --hostfile $HOSTFILE benchmark.py -g -x -b 16
+colossalai run --nproc_per_node 8 --hostfile $HOSTFILE benchmark.py -g -b 16
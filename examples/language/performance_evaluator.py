@@ -1,9 +1,8 @@
 from time import time
-from typing import Optional
+from typing import Optional, Sequence
 
 import torch
 import torch.distributed as dist
-from torch import Tensor
 from torch.profiler import ProfilerActivity, profile, schedule, tensorboard_trace_handler
 
 from colossalai.accelerator import get_accelerator
@@ -138,13 +137,15 @@ class PerformanceEvaluator:
         # get_accelerator().synchronize()
         self.timer.start()
 
-    def on_step_end(self, input_ids: Tensor, **kwargs) -> None:
+    def on_step_end(self, input_shape: Sequence[int], **kwargs) -> None:
         if self.disable:
             return
         # get_accelerator().synchronize()
         self.timer.end()
 
-        batch_size, seq_len = input_ids.shape
+        # only the batch shape is needed, so call sites pass a (batch_size, seq_len)
+        # tuple instead of the input tensor itself
+        batch_size, seq_len = input_shape
 
         self.num_samples += batch_size
         checkpoint_activations_factor = 3 + int(self.enable_grad_checkpoint)